@@ -38,8 +38,7 @@ def get_dataset_fn(dataset_name: str) -> str:
     Returns:
         str: The full file path of the dataset.
     """
-    if not os.path.exists("data"):
-        os.mkdir("data")
+    os.makedirs("data", exist_ok=True)
     return os.path.join("data", f"{dataset_name}.hdf5")
 
 
@@ -67,7 +66,8 @@ def get_dataset(dataset_name: str) -> Tuple[h5py.File, int]:
             print("Creating dataset locally")
             DATASETS[dataset_name](hdf5_filename)
 
-    hdf5_file = h5py.File(hdf5_filename, "r")
+    # larger chunk cache for the block-wise reads of the ground truth
+    hdf5_file = h5py.File(hdf5_filename, "r", rdcc_nbytes=64 << 20)
 
     # here for backward compatibility, to ensure old datasets can still be used with newer versions
     # cast to integer because the json parser (later on) cannot interpret numpy integers
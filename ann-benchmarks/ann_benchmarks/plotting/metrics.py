@@ -2,6 +2,10 @@ from __future__ import absolute_import
 
 import numpy as np
 
+# Number of ground truth rows read at a time; the dataset distances may be an
+# h5py dataset, which is then streamed in blocks rather than loaded at once
+DISTANCES_CHUNK_ROWS = 1024
+
 
 def knn_threshold(data, count, epsilon):
     return data[count - 1] + epsilon
@@ -13,13 +17,15 @@ def epsilon_threshold(data, count, epsilon):
 
 def get_recall_values(dataset_distances, run_distances, count, threshold, epsilon=1e-3):
     recalls = np.zeros(len(run_distances))
-    for i in range(len(run_distances)):
-        t = threshold(dataset_distances[i], count, epsilon)
-        actual = 0
-        for d in run_distances[i][:count]:
-            if d <= t:
-                actual += 1
-        recalls[i] = actual
+    for start in range(0, len(run_distances), DISTANCES_CHUNK_ROWS):
+        block = dataset_distances[start : start + DISTANCES_CHUNK_ROWS]
+        for i in range(start, min(start + DISTANCES_CHUNK_ROWS, len(run_distances))):
+            t = threshold(block[i - start], count, epsilon)
+            actual = 0
+            for d in run_distances[i][:count]:
+                if d <= t:
+                    actual += 1
+            recalls[i] = actual
     return (np.mean(recalls) / float(count), np.std(recalls) / float(count), recalls)
 
 
@@ -55,9 +61,11 @@ def rel(dataset_distances, run_distances, metrics):
         print("Computing rel metrics")
         total_closest_distance = 0.0
         total_candidate_distance = 0.0
-        for true_distances, found_distances in zip(dataset_distances, run_distances):
-            total_closest_distance += np.sum(true_distances)
-            total_candidate_distance += np.sum(found_distances)
+        for start in range(0, len(run_distances), DISTANCES_CHUNK_ROWS):
+            block = dataset_distances[start : start + DISTANCES_CHUNK_ROWS]
+            for true_distances, found_distances in zip(block, run_distances[start : start + DISTANCES_CHUNK_ROWS]):
+                total_closest_distance += np.sum(true_distances)
+                total_candidate_distance += np.sum(found_distances)
         if total_closest_distance < 0.01:
             metrics.attrs["rel"] = float("inf")
         else:
@@ -3,11 +3,16 @@ from __future__ import absolute_import
 import itertools
 import hashlib
 import colorsys
+import json
+import os
 
 import numpy as np
 
 from ann_benchmarks.plotting.metrics import all_metrics as metrics
 
+# Per-run metric values, shared by data_export.py and plot.py
+METRICS_CACHE_DIR = os.path.join("reports", ".metric_cache")
+
 
 def get_or_create_metrics(run):
     if "metrics" not in run:
@@ -15,36 +20,123 @@ def get_or_create_metrics(run):
     return run["metrics"]
 
 
+def _metrics_cache_entry(cache_dir, dataset_stat, run, properties):
+    # One entry per result file, so storing a row replaces any stale one and the
+    # cache stays bounded by the number of result files. Re-running a benchmark
+    # rewrites the attributes of its result file, so hashing them (rather than
+    # the mtime, which changes whenever the metrics group is updated) into the
+    # entry's key invalidates it; dataset_stat does the same for a regenerated
+    # ground truth file
+    fn = os.path.join(cache_dir, hashlib.sha1(run.filename.encode("utf-8")).hexdigest() + ".json")
+    key = json.dumps([dataset_stat, sorted(properties.items())], default=str)
+    return fn, hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _load_cached_row(fn, key):
+    entry = _load_cached_json(fn)
+    if not isinstance(entry, dict) or entry.get("key") != key:
+        return None
+    return entry["row"]
+
+
+def _store_cached_row(fn, key, row):
+    _store_cached_json(fn, {"key": key, "row": row})
+
+
+def _dataset_stat(dataset):
+    # dataset is the ground truth hdf5 file, or one of its datasets
+    fn = dataset.file.filename
+    st = os.stat(fn)
+    return [fn, st.st_mtime, st.st_size]
+
+
+def _json_default(o):
+    # numpy scalars (as read from hdf5 attributes) are not json serializable
+    return o.item() if hasattr(o, "item") else str(o)
+
+
+def _plain_value(v):
+    # numpy floats become the Python float of their shortest repr (float32 metrics
+    # would otherwise gain digits), so a row is the same whether computed or cached
+    if isinstance(v, np.floating):
+        return float(str(v))
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def _load_cached_json(fn):
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _store_cached_json(fn, value):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    # per-process temporary file, as several workers may store the same entry
+    tmp_fn = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmp_fn, "w") as f:
+        json.dump(value, f, default=_json_default)
+    os.replace(tmp_fn, fn)
+
+
+def pointset_columns(data):
+    """Turn a list of (algo, algo_name, x, y) runs into per-field columns."""
+    return {
+        "names": np.array([t[1] for t in data], dtype=object),
+        "xs": np.array([t[2] for t in data], dtype=float),
+        "ys": np.array([t[3] for t in data], dtype=float),
+    }
+
+
 def create_pointset(data, xn, yn):
     xm, ym = (metrics[xn], metrics[yn])
     rev_y = -1 if ym["worst"] < 0 else 1
     rev_x = -1 if xm["worst"] < 0 else 1
-    data.sort(key=lambda t: (rev_y * t[-1], rev_x * t[-2]))
-
-    axs, ays, als = [], [], []
-    # Generate Pareto frontier
-    xs, ys, ls = [], [], []
-    last_x = xm["worst"]
-    comparator = (lambda xv, lx: xv > lx) if last_x < 0 else (lambda xv, lx: xv < lx)
-    for algo, algo_name, xv, yv in data:
-        if not xv or not yv:
-            continue
-        axs.append(xv)
-        ays.append(yv)
-        als.append(algo_name)
-        if comparator(xv, last_x):
-            last_x = xv
-            xs.append(xv)
-            ys.append(yv)
-            ls.append(algo_name)
+    # data is either the columns from pointset_columns or a list of run tuples
+    if not isinstance(data, dict):
+        data = pointset_columns(data)
+    names, x, y = data["names"], data["xs"], data["ys"]
+    # Runs missing either value are not plotted
+    keep = (x != 0) & (y != 0) & ~np.isnan(x) & ~np.isnan(y)
+    names, x, y = names[keep], x[keep], y[keep]
+    order = np.lexsort((rev_x * x, rev_y * y))
+    names, x, y = names[order], x[order], y[order]
+
+    # Generate Pareto frontier: a run is on it if its x beats every x sorted before it
+    worst = np.array([xm["worst"]])
+    if xm["worst"] < 0:
+        on_frontier = x > np.maximum.accumulate(np.concatenate([worst, x]))[:-1]
+    else:
+        on_frontier = x < np.minimum.accumulate(np.concatenate([worst, x]))[:-1]
+    xs, ys, ls = x[on_frontier].tolist(), y[on_frontier].tolist(), names[on_frontier].tolist()
+    axs, ays, als = x.tolist(), y.tolist(), names.tolist()
     return xs, ys, ls, axs, ays, als
 
 
-def compute_metrics(true_nn_distances, res, metric_1, metric_2, recompute=False):
+def compute_metrics(true_nn_distances, res, metric_1, metric_2, recompute=False, cache_dir=None):
     all_results = {}
+    if cache_dir is not None:
+        dataset_stat = _dataset_stat(true_nn_distances)
     for i, (properties, run) in enumerate(res):
         algo = properties["algo"]
         algo_name = properties["name"]
+
+        # Same entries as compute_metrics_all_runs: a hit skips loading the run's hdf5 data,
+        # a miss adds the two metrics to whatever the entry already holds
+        cache_fn, cached = None, {}
+        if cache_dir is not None:
+            cache_fn, cache_key = _metrics_cache_entry(cache_dir, dataset_stat, run, properties)
+            if not recompute:
+                cached = _load_cached_row(cache_fn, cache_key) or {}
+                if metric_1 in cached and metric_2 in cached:
+                    metric_1_value, metric_2_value = cached[metric_1], cached[metric_2]
+                    print("%3d: %80s %12.3f %12.3f" % (i, algo_name, metric_1_value, metric_2_value))
+                    all_results.setdefault(algo, []).append((algo, algo_name, metric_1_value, metric_2_value))
+                    continue
+
         # cache distances to avoid access to hdf5 file
         run_distances = np.array(run["distances"])
         # cache times to avoid access to hdf5 file
@@ -59,6 +151,11 @@ def compute_metrics(true_nn_distances, res, metric_1, metric_2, recompute=False)
         metric_2_value = metrics[metric_2]["function"](
             true_nn_distances, run_distances, metrics_cache, times, properties
         )
+        if cache_fn is not None:
+            metric_1_value, metric_2_value = _plain_value(metric_1_value), _plain_value(metric_2_value)
+            cached.update({"algorithm": algo, "parameters": algo_name, "count": _plain_value(properties["count"])})
+            cached.update({metric_1: metric_1_value, metric_2: metric_2_value})
+            _store_cached_row(cache_fn, cache_key, cached)
 
         print("%3d: %80s %12.3f %12.3f" % (i, algo_name, metric_1_value, metric_2_value))
 
@@ -89,11 +186,27 @@ def compute_all_metrics(true_nn_distances, run, properties, recompute=False):
     return (algo, algo_name, results)
 
 
-def compute_metrics_all_runs(dataset, res, recompute=False):
-    true_nn_distances = list(dataset["distances"])
+def compute_metrics_all_runs(dataset, res, recompute=False, cache_dir=None):
+    true_nn_distances = None
+    if cache_dir is not None:
+        dataset_stat = _dataset_stat(dataset)
     for i, (properties, run) in enumerate(res):
         algo = properties["algo"]
         algo_name = properties["name"]
+
+        # metrics of unchanged runs are read back from cache_dir without touching the run's hdf5 data;
+        # recompute skips the lookup but still refreshes the cached entry
+        cache_fn = None
+        if cache_dir is not None:
+            cache_fn, cache_key = _metrics_cache_entry(cache_dir, dataset_stat, run, properties)
+            if not recompute:
+                run_result = _load_cached_row(cache_fn, cache_key)
+                if run_result is not None and all(name in run_result for name in metrics):
+                    yield run_result
+                    continue
+
+        if true_nn_distances is None:
+            true_nn_distances = list(dataset["distances"])
         # cache distances to avoid access to hdf5 file
         # print('Load distances and times')
         run_distances = np.array(run["distances"])
@@ -104,12 +217,12 @@ def compute_metrics_all_runs(dataset, res, recompute=False):
             del run["metrics"]
         metrics_cache = get_or_create_metrics(run)
 
-        dataset = properties["dataset"]
-
-        run_result = {"algorithm": algo, "parameters": algo_name, "count": properties["count"]}
+        run_result = {"algorithm": algo, "parameters": algo_name, "count": _plain_value(properties["count"])}
         for name, metric in metrics.items():
             v = metric["function"](true_nn_distances, run_distances, metrics_cache, times, properties)
-            run_result[name] = v
+            run_result[name] = _plain_value(v)
+        if cache_fn is not None:
+            _store_cached_row(cache_fn, cache_key, run_result)
         yield run_result
 
 
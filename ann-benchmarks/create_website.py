@@ -3,6 +3,7 @@ import datetime
 
 mpl.use("Agg")  # noqa
 import argparse
+import functools
 import hashlib
 import os
 
@@ -18,6 +19,9 @@ from ann_benchmarks.plotting.utils import (compute_all_metrics,
                                            create_linestyles, create_pointset,
                                            get_plot_label)
 
+# Datasets are reopened each time the run description changes; share one read-only handle per dataset
+get_dataset = functools.cache(get_dataset)
+
 colors = [
     "rgba(166,206,227,1)",
     "rgba(31,120,180,1)",
@@ -1,11 +1,20 @@
 import argparse
 import os
 import datetime
-import csv
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
 from ann_benchmarks.datasets import DATASETS, get_dataset
-from ann_benchmarks.plotting.utils import compute_metrics_all_runs
-from ann_benchmarks.results import load_all_results
+from ann_benchmarks.main import positive_int
+from ann_benchmarks.plotting.utils import METRICS_CACHE_DIR, compute_metrics_all_runs
+from ann_benchmarks.results import build_result_filepath, load_all_results
+
+CSV_BATCH_ROWS = 4096
 
 # Function to get the current date in yymmdd format
 def get_date_str():
@@ -16,10 +25,46 @@ def ensure_reports_dir():
     if not os.path.exists('reports'):
         os.makedirs('reports')
 
+# Compute the metrics rows of one dataset; runs in a worker process, so it
+# opens its own HDF5 handles and only returns plain dicts
+def _process_dataset(dataset_name, recompute):
+    # load_all_results yields open HDF5 handles, so peek at the first
+    # one instead of materializing the generator (which would close them)
+    results = load_all_results(dataset_name, batch_mode=True)
+    first = next(results, None)
+    if first is None:
+        return []
+    print("Looking at dataset", dataset_name)
+    results = itertools.chain([first], results)
+    dataset, _ = get_dataset(dataset_name)
+    rows = []
+    for res in compute_metrics_all_runs(dataset, results, recompute, METRICS_CACHE_DIR):
+        res["dataset"] = dataset_name
+        rows.append(res)
+    return rows
+
+# Open the output csv with its columns taken from the first row. Returns a
+# function writing a list of rows at once, and one closing the file
+def open_rows_writer(path, first_row):
+    schema = pa.schema([(name, pa.string() if isinstance(v, str) else pa.float64()) for name, v in first_row.items()])
+    writer = pacsv.CSVWriter(
+        path, schema, write_options=pacsv.WriteOptions(batch_size=CSV_BATCH_ROWS, quoting_style="needed")
+    )
+
+    def write_rows(rows):
+        # float32 values are written with their own shortest repr, not the digits of their float64 widening
+        rows = [{name: float(str(v)) if isinstance(v, np.floating) else v for name, v in row.items()} for row in rows]
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+
+    return write_rows, writer.close
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--output", help="Path to the output file", required=False)
     parser.add_argument("--recompute", action="store_true", help="Recompute metrics")
+    parser.add_argument(
+        "--proc", type=positive_int, default=os.cpu_count(), help="Number of datasets processed in parallel"
+    )
     args = parser.parse_args()
 
     # Ensure the reports directory exists
@@ -37,22 +82,23 @@ if __name__ == "__main__":
         else:
             args.output = f"{name}-{get_date_str()}{ext}"
 
-    datasets = DATASETS.keys()
-    dfs = []
-    for dataset_name in datasets:
-        print("Looking at dataset", dataset_name)
-        if len(list(load_all_results(dataset_name, batch_mode=True))) > 0:
-            results = load_all_results(dataset_name, batch_mode=True)
-            dataset, _ = get_dataset(dataset_name)
-            results = compute_metrics_all_runs(dataset, results, args.recompute)
-            for res in results:
-                res["dataset"] = dataset_name
-                dfs.append(res)
-    if len(dfs) > 0:
-        with open(args.output, "w", newline="") as csvfile:
-            names = list(dfs[0].keys())
-            writer = csv.DictWriter(csvfile, fieldnames=names)
-            writer.writeheader()
-            for res in dfs:
-                writer.writerow(res)
-
+    # Only datasets with a results directory can have runs to export; this
+    # skips a worker task (and any dataset download) for all the others
+    datasets = [dataset_name for dataset_name in DATASETS if os.path.isdir(build_result_filepath(dataset_name))]
+    # Rows are streamed to the csv dataset by dataset, in DATASETS order so that exports
+    # stay diffable; the file is only created (and the header taken from the first row)
+    # once there is data
+    write_rows, close = None, None
+    try:
+        with ProcessPoolExecutor(max_workers=args.proc) as executor:
+            futures = [executor.submit(_process_dataset, dataset_name, args.recompute) for dataset_name in datasets]
+            for future in futures:
+                rows = future.result()
+                if not rows:
+                    continue
+                if write_rows is None:
+                    write_rows, close = open_rows_writer(args.output, rows[0])
+                write_rows(rows)
+    finally:
+        if close is not None:
+            close()
@@ -1,54 +1,122 @@
 import matplotlib as mpl
 
 mpl.use("Agg")  # noqa
+# Let Agg merge line segments that deviate less than a pixel from the drawn path
+# and render long paths in chunks; markers are still drawn at every point
+mpl.rcParams["path.simplify"] = True
+mpl.rcParams["path.simplify_threshold"] = 1.0
+mpl.rcParams["agg.path.chunksize"] = 10000
 import collections
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 
 from ann_benchmarks.datasets import get_dataset
+from ann_benchmarks.main import positive_int
 from ann_benchmarks.plotting.metrics import all_metrics as metrics
 from ann_benchmarks.plotting.utils import (compute_metrics, create_linestyles,
-                                           create_pointset, get_plot_label)
+                                           create_pointset, get_plot_label,
+                                           pointset_columns, METRICS_CACHE_DIR)
 from ann_benchmarks.results import get_unique_algorithms, load_all_results
 
 
-def create_plot(all_data, raw, x_scale, y_scale, xn, yn, fn_out, linestyles, batch):
+def sort_by_x(xs, ys):
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    order = np.argsort(xs, kind="stable")
+    return xs[order], ys[order]
+
+
+def pointset_stats(xs, ys):
+    """Returns the sort key (mean of -log y) and the smallest x > 0 and largest x < 1 of a pointset."""
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    pos, lt1 = xs[xs > 0], xs[xs < 1]
+    return -np.log(ys).mean(), (pos.min() if pos.size else 1), (lt1.max() if lt1.size else 0)
+
+
+def create_plot(all_data, raw, x_scale, y_scale, xn, yn, fn_out, linestyles, batch, dpi=100, fig=None):
     xm, ym = (metrics[xn], metrics[yn])
     # Now generate each plot
     handles = []
     labels = []
-    plt.figure(figsize=(12, 9))
+    # A figure passed in is cleared and reused, which saves setting up (and
+    # tearing down) a new one when generating many plots
+    close_fig = fig is None
+    if fig is None:
+        fig = plt.figure(figsize=(12, 9))
+    else:
+        fig.clear()
+        plt.figure(fig.number)
+    fig.add_subplot(111)
+
+    # Build every pointset once; both the sort and the plotting loop use them
+    pointsets = {algo: create_pointset(all_data[algo], xn, yn) for algo in all_data}
+
+    stats = {algo: pointset_stats(pointsets[algo][0], pointsets[algo][1]) for algo in pointsets}
 
     # Sorting by mean y-value helps aligning plots with labels
-    def mean_y(algo):
-        xs, ys, ls, axs, ays, als = create_pointset(all_data[algo], xn, yn)
-        return -np.log(np.array(ys)).mean()
+    algos = list(pointsets)
+    order = np.argsort([stats[algo][0] for algo in algos], kind="stable")
+
+    # Lines go into one LineCollection per style (frontier, faded raw) and markers
+    # into one scatter per marker shape, instead of a Line2D artist per algorithm
+    lines, line_colors, raw_lines, raw_colors = [], [], [], []
+    points = collections.defaultdict(lambda: ([], [], [], [], []))
+
+    def add_points(marker, xs, ys, color, ms, mew):
+        pxs, pys, pcolors, psizes, pwidths = points[marker]
+        pxs.append(xs)
+        pys.append(ys)
+        pcolors.extend([color] * len(xs))
+        psizes.extend([ms**2] * len(xs))
+        pwidths.extend([mew] * len(xs))
 
     # Find range for logit x-scale
     min_x, max_x = 1, 0
-    for algo in sorted(all_data.keys(), key=mean_y):
-        xs, ys, ls, axs, ays, als = create_pointset(all_data[algo], xn, yn)
-        min_x = min([min_x] + [x for x in xs if x > 0])
-        max_x = max([max_x] + [x for x in xs if x < 1])
+    for algo in (algos[i] for i in order):
+        xs, ys, ls, axs, ays, als = pointsets[algo]
+        # Draw monotonic-x paths so Agg's simplification can collapse dense runs
+        xs, ys = sort_by_x(xs, ys)
+        axs, ays = sort_by_x(axs, ays)
+        _, algo_min_x, algo_max_x = stats[algo]
+        min_x, max_x = min(min_x, algo_min_x), max(max_x, algo_max_x)
         color, faded, linestyle, marker = linestyles[algo]
         #marker = '.'
         #if args.marker:
         #    marker = args.marker
 
-        (handle,) = plt.plot(
-            xs, ys, "-", label=algo, color=color, ms=7, mew=3, lw=3, marker=marker
-        )
-        handles.append(handle)
+        lines.append(np.column_stack([xs, ys]))
+        line_colors.append(color)
+        add_points(marker, xs, ys, color, 7, 3)
         if raw:
-            (handle2,) = plt.plot(
-                axs, ays, "-", label=algo, color=faded, ms=5, mew=2, lw=2, marker=marker
-            )
+            raw_lines.append(np.column_stack([axs, ays]))
+            raw_colors.append(faded)
+            add_points(marker, axs, ays, faded, 5, 2)
+        handles.append(Line2D([], [], color=color, ms=7, mew=3, lw=3, marker=marker))
         labels.append(algo)
 
     ax = plt.gca()
+    # Traces are rasterized (at dpi) even in vector output; axes and text stay vector
+    artists = []
+    if raw_lines:
+        artists.append(ax.add_collection(LineCollection(raw_lines, colors=raw_colors, linewidths=2)))
+    artists.append(ax.add_collection(LineCollection(lines, colors=line_colors, linewidths=3)))
+    # Markers go above all lines (scatter defaults to zorder 1, LineCollection to 2)
+    for marker, (pxs, pys, pcolors, psizes, pwidths) in points.items():
+        artists.append(
+            ax.scatter(
+                np.concatenate(pxs), np.concatenate(pys), s=psizes, c=pcolors, linewidths=pwidths, marker=marker,
+                zorder=2.5,
+            )
+        )
+    for artist in artists:
+        artist.set_rasterized(True)
+    ax.autoscale_view()
+
     ax.set_ylabel(ym["description"])
     ax.set_xlabel(xm["description"])
     # Custom scales of the type --x-scale a3
@@ -94,8 +162,24 @@ def create_plot(all_data, raw, x_scale, y_scale, xn, yn, fn_out, linestyles, bat
     # Workaround for bug https://github.com/matplotlib/matplotlib/issues/6789
     ax.spines["bottom"]._adjust_location()
 
-    plt.savefig(fn_out, bbox_inches="tight", dpi=144)
-    plt.close()
+    plt.savefig(fn_out, bbox_inches="tight", dpi=dpi)
+    if close_fig:
+        plt.close(fig)
+
+# Figure reused by all plots rendered in a worker process
+_worker_fig = None
+
+
+def init_plot_worker(dark):
+    global _worker_fig
+    if dark:
+        plt.style.use('dark_background')
+    _worker_fig = plt.figure(figsize=(12, 9))
+
+
+def render_plot(plot_args):
+    create_plot(*plot_args, fig=_worker_fig)
+
 
 def print_result_info(results):
     # Load just the first result to see its structure
@@ -156,6 +240,13 @@ if __name__ == "__main__":
     )
     parser.add_argument("--batch", help="Plot runs in batch mode", action="store_true")
     parser.add_argument("--recompute", help="Clears the cache and recomputes the metrics", action="store_true")
+    parser.add_argument(
+        "--dpi", help="Resolution of the output (and of the rasterized traces in .svg/.pdf output)", type=int,
+        default=100
+    )
+    parser.add_argument(
+        "--proc", type=positive_int, default=os.cpu_count(), help="Number of plots rendered in parallel"
+    )
     args = parser.parse_args()
     directory_path(args.outputdir)
 
@@ -168,13 +259,18 @@ if __name__ == "__main__":
     unique_algorithms = get_unique_algorithms()
     results = load_all_results(args.dataset, count, args.batch)
     linestyles = create_linestyles(sorted(unique_algorithms), args.dark)
-    runs = compute_metrics(np.array(dataset["distances"]), results, args.x_axis, args.y_axis, args.recompute)
+    # The ground truth stays in the hdf5 file; the metrics read it in blocks
+    true_nn_distances = dataset["distances"]
+    runs = compute_metrics(true_nn_distances, results, args.x_axis, args.y_axis, args.recompute, METRICS_CACHE_DIR)
+    runs = {algo: pointset_columns(algo_runs) for algo, algo_runs in runs.items()}
     if not runs:
         raise Exception("Nothing to plot")
 
     if args.dark:
         plt.style.use('dark_background')
     
+    fig = plt.figure(figsize=(12, 9))
+    group_plots = []
     if args.algo:
         # Step 1: Group all algorithms by their base prefix
         grouped_algos = collections.defaultdict(list)
@@ -191,25 +287,34 @@ if __name__ == "__main__":
 
         print(algo_to_group)
 
-        # Step 3: For all other groups, plot args.algo vs the whole group
+        # Step 3: Index the computed runs by group once, instead of filtering all runs for every group
+        runs_by_group = collections.defaultdict(dict)
+        for algo, algo_runs in runs.items():
+            runs_by_group[algo.split("-")[0]][algo] = algo_runs
+        args_runs = {args.algo: runs[args.algo]} if args.algo in runs else {}
+
+        # Step 4: For all other groups, plot args.algo vs the whole group
         for base, group in grouped_algos.items():
             if base == args_group:
                 continue  # skip group containing args.algo
 
-            allowed_algorithm_keys = [args.algo] + group
-            print(allowed_algorithm_keys)
-            filtered_results = {
-                algo: results for algo, results in runs.items()
-                if algo in allowed_algorithm_keys
-            }
+            print([args.algo] + group)
+            filtered_results = {**args_runs, **runs_by_group[base]}
 
             output_file = args.outputdir + f"/{args.algo}-vs-{base}-{args.dataset}.png"
-            create_plot(
+            group_plots.append((
                 filtered_results, args.raw, args.x_scale, args.y_scale,
-                args.x_axis, args.y_axis, output_file, linestyles, args.batch
-            )
-
-        
-    create_plot(
-        runs, args.raw, args.x_scale, args.y_scale, args.x_axis, args.y_axis, args.output, linestyles, args.batch
-    )
+                args.x_axis, args.y_axis, output_file, linestyles, args.batch, args.dpi
+            ))
+
+    # Group plots are independent renders, so they are spread over worker processes
+    # while the main plot is rendered here
+    with ProcessPoolExecutor(max_workers=args.proc, initializer=init_plot_worker, initargs=(args.dark,)) as executor:
+        futures = [executor.submit(render_plot, plot_args) for plot_args in group_plots]
+        create_plot(
+            runs, args.raw, args.x_scale, args.y_scale, args.x_axis, args.y_axis, args.output, linestyles, args.batch,
+            args.dpi, fig
+        )
+        for future in futures:
+            future.result()
+    plt.close(fig)